@@ -1,13 +1,16 @@
 import argparse
 import os
-os.environ["TOKENIZERS_PARALLELISM"] = "false"
+# Let the tokenizers library train and encode with multiple threads. DataLoader workers never call the
+# tokenizer (the splits are encoded up front), so forking after it has run in parallel is safe.
+os.environ["TOKENIZERS_PARALLELISM"] = "true"
 import math
 import logging
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import psutil
-import gc
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, cohen_kappa_score
 from tokenizers import Tokenizer, models, pre_tokenizers, trainers
@@ -80,11 +83,13 @@ def parse_args():
     parser.add_argument("--num_layers", type=int, default=4, help="Number of transformer layers")
     parser.add_argument("--max_seq_length", type=int, default=256, help="Maximum sequence length")
     parser.add_argument("--batch_size", type=int, default=32, help="Batch size for training and validation")
+    parser.add_argument("--grad_accum_steps", type=int, default=1, help="Number of batches to accumulate gradients over before each optimizer step")
     parser.add_argument("--model_dropout_rate", type=float, default=0.2, help="Dropout rate for the model")
     parser.add_argument("--learning_rate", type=float, default=0.0001, help="Learning rate")
     parser.add_argument("--lr_scheduler_factor", type=float, default=0.5, help="Factor by which the learning rate will be reduced by the learning rate scheduler")
     parser.add_argument("--lr_patience", type=int, default=10, help="Patience for learning rate reduction")
     parser.add_argument("--weight_decay", type=float, default=1e-4, help="Weight decay for the optimizer")
+    parser.add_argument("--optimizer", type=str, default="adam", choices=["adam", "adamw", "adamw_8bit"], help="Optimizer to use: 'adam', 'adamw' (decoupled weight decay) or 'adamw_8bit' (requires bitsandbytes)")
     parser.add_argument("--early_stop_patience", type=int, default=20, help="Patience for early stopping")
     parser.add_argument("--min_delta", type=float, default=0.01, help="Minimum delta for early stopping")
     parser.add_argument("--epochs", type=int, default=50, help="Number of training epochs")
@@ -94,9 +99,17 @@ def parse_args():
     parser.add_argument("--train_size", type=float, default=0.8, help="Proportion of the dataset to include in the training set")
     parser.add_argument("--val_size", type=float, default=0.1, help="Proportion of the dataset to include in the validation set")
     parser.add_argument("--seed", type=int, default=42, help="Random seed for reproducibility")
+    parser.add_argument("--deterministic", action="store_true", help="Use deterministic cuDNN algorithms for bit-for-bit reproducible runs (slower)")
     parser.add_argument("--pe_max_len", type=int, default=5000, help="Maximum length for positional encoding")
     parser.add_argument("--pe_dropout_rate", type=float, default=0.1, help="Dropout rate for positional encoding")
     parser.add_argument("--log_dir", type=str, default="logs", help="Directory to save TensorBoard logs")
+    parser.add_argument("--amp", type=str, default="off", choices=["off", "fp16", "bf16"], help="Mixed precision mode: 'off' (FP32), 'fp16' (with gradient scaling) or 'bf16'")
+    parser.add_argument("--loss_chunk_size", type=int, default=4096, help="Number of tokens per chunk when computing the cross-entropy loss")
+    parser.add_argument("--no_length_bucketing", action="store_true", help="Disable batching of genomes with similar lengths (batches are still padded to their longest genome)")
+    parser.add_argument("--compile", action="store_true", help="Compile the model with torch.compile for fused kernels (requires PyTorch 2.0 or later)")
+    parser.add_argument("--no_pin_memory", action="store_true", help="Do not load batches into pinned (page-locked) host memory before copying them to the GPU")
+    parser.add_argument("--num_workers", type=int, default=0, help="Number of DataLoader worker processes (0 loads data in the main process)")
+    parser.add_argument("--prefetch_factor", type=int, default=4, help="Number of batches each DataLoader worker prepares ahead of time (only used with --num_workers > 0)")
     
     args = parser.parse_args()
 
@@ -104,6 +117,13 @@ def parse_args():
     if args.pe_max_len < args.max_seq_length:
         raise ValueError(f"Error: pe_max_len ({args.pe_max_len}) must be greater than or equal to max_seq_length ({args.max_seq_length}).")
 
+    if args.grad_accum_steps < 1:
+        raise ValueError(f"Error: grad_accum_steps ({args.grad_accum_steps}) must be at least 1.")
+    if args.loss_chunk_size < 1:
+        raise ValueError(f"Error: loss_chunk_size ({args.loss_chunk_size}) must be at least 1.")
+    if args.prefetch_factor < 1:
+        raise ValueError(f"Error: prefetch_factor ({args.prefetch_factor}) must be at least 1.")
+
     if args.model_type == "longformer":
         # Ensure max_seq_length is greater than or equal to longformer_attention_window
         args.max_seq_length = max(args.max_seq_length, args.longformer_attention_window)
@@ -124,10 +144,12 @@ num_heads = args.num_heads
 num_layers = args.num_layers
 max_seq_length = args.max_seq_length
 batch_size = args.batch_size
+grad_accum_steps = args.grad_accum_steps
 model_dropout_rate = args.model_dropout_rate
 learning_rate = args.learning_rate
 lr_scheduler_factor = args.lr_scheduler_factor
 weight_decay = args.weight_decay
+optimizer_name = args.optimizer
 lr_patience = args.lr_patience
 early_stop_patience =args.early_stop_patience
 min_delta = args.min_delta
@@ -141,6 +163,11 @@ seed = args.seed
 pe_max_len = args.pe_max_len
 pe_dropout_rate = args.pe_dropout_rate
 log_dir = args.log_dir
+num_workers = args.num_workers
+prefetch_factor = args.prefetch_factor
+bucket_by_length = not args.no_length_bucketing
+loss_chunk_size = args.loss_chunk_size
+amp_dtype = {"off": None, "fp16": torch.float16, "bf16": torch.bfloat16}[args.amp]
 
 # Check if max_seq_length is a multiple of longformer_attention_window when using Longformer
 if model_type == "longformer" and max_seq_length % longformer_attention_window != 0:
@@ -158,24 +185,27 @@ if model_save_path and not os.path.isdir(os.path.dirname(model_save_path)):
     print(f"Error: The directory for model save path '{model_save_path}' does not exist.")
     exit(1)
 
-def set_seed(seed):
+def set_seed(seed, deterministic=False):
     """
     Set the random seed for reproducibility.
 
     Args:
     - seed (int): The random seed value to set.
+    - deterministic (bool): Whether to restrict cuDNN to deterministic algorithms.
 
     This function sets the random seed for the random number generators in PyTorch,
     NumPy, and Python's built-in random module to ensure reproducibility of results.
+    Bit-for-bit reproducible GPU results additionally need deterministic cuDNN
+    algorithms; otherwise cuDNN is left free to benchmark and pick the fastest ones.
     """
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
     np.random.seed(seed)
     random.seed(seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    torch.backends.cudnn.deterministic = deterministic
+    torch.backends.cudnn.benchmark = not deterministic
 
-set_seed(args.seed)
+set_seed(args.seed, args.deterministic)
 
 def print_parameters_table(params: dict) -> None:
     """
@@ -228,6 +258,59 @@ def load_dataset(input_file):
         print(f"An error occurred while reading the file: {e}")
         exit(1)
 
+# Checkpoints are written to disk on a background thread so training does not wait on file I/O
+checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+pending_checkpoint = None
+
+def _copy_to_cpu(state):
+    """
+    Copy every tensor in a (nested) state dictionary to the CPU.
+
+    Args:
+    - state: A tensor, or a dict, list or tuple containing tensors.
+
+    Returns:
+    - A copy of the state whose tensors are detached CPU copies.
+
+    The tensors are always copied, even if they are already on the CPU, so that later
+    in-place updates by the optimizer cannot change a checkpoint that is still being written.
+    Dictionaries keep their type and any _metadata attribute, which model state dicts use to
+    record the per-module versions that load_state_dict passes on.
+    """
+
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        state_copy = type(state)((key, _copy_to_cpu(value)) for key, value in state.items())
+        if hasattr(state, "_metadata"):
+            state_copy._metadata = state._metadata
+        return state_copy
+    if isinstance(state, (list, tuple)):
+        return type(state)(_copy_to_cpu(value) for value in state)
+    return state
+
+def _write_checkpoint(checkpoint, save_path):
+    """
+    Write a checkpoint dictionary to a file.
+
+    Args:
+    - checkpoint (dict): The checkpoint to write.
+    - save_path (str): Path to save the model checkpoint file.
+    """
+
+    try:
+        torch.save(checkpoint, save_path)
+    except IOError as e:
+        print(f"Failed to save checkpoint to '{save_path}': {e}")
+
+def wait_for_checkpoint():
+    """
+    Block until the most recently started checkpoint save has been written.
+    """
+
+    if pending_checkpoint is not None:
+        pending_checkpoint.result()
+
 def save_checkpoint(model, optimizer, epoch, loss, save_path):
     """
     Save the model checkpoint to a file.
@@ -241,18 +324,19 @@ def save_checkpoint(model, optimizer, epoch, loss, save_path):
 
     This function saves the model checkpoint, including the model state dictionary,
     optimizer state dictionary, current epoch number, and loss value, to the specified file.
+    The states are copied to the CPU immediately and the file is written in the background;
+    call wait_for_checkpoint() to make sure the write has finished.
     """
 
-    try:
-        checkpoint = {
-            "epoch": epoch,
-            "model_state_dict": model.state_dict(),
-            "optimizer_state_dict": optimizer.state_dict(),
-            "loss": loss,
-        }
-        torch.save(checkpoint, save_path)
-    except IOError as e:
-        print(f"Failed to save checkpoint to '{save_path}': {e}")
+    global pending_checkpoint
+    wait_for_checkpoint()  # Keep at most one checkpoint in flight
+    checkpoint = {
+        "epoch": epoch,
+        "model_state_dict": _copy_to_cpu(model.state_dict()),
+        "optimizer_state_dict": _copy_to_cpu(optimizer.state_dict()),
+        "loss": loss,
+    }
+    pending_checkpoint = checkpoint_executor.submit(_write_checkpoint, checkpoint, save_path)
 
 def load_checkpoint(model, optimizer, checkpoint_path):
     """
@@ -310,40 +394,90 @@ def _is_compatible_checkpoint(model, checkpoint):
 
     return model.vocab_size == checkpoint["model_state_dict"]["embed.weight"].size(0)
 
-def train_model(train_loader, model, optimizer, criterion, device):
+def compute_loss(outputs, labels, criterion, vocab_size, chunk_size):
+    """
+    Compute the cross-entropy loss over the flattened tokens in chunks.
+
+    Args:
+    - outputs (Tensor): Model logits of shape (batch, seq_len, vocab_size).
+    - labels (Tensor): Target token ids of shape (batch, seq_len), with padded positions set to
+                       criterion.ignore_index (-100), as GenomeDataset.collate_batch does.
+    - criterion: Loss criterion with reduction='sum'.
+    - vocab_size (int): Size of the vocabulary.
+    - chunk_size (int): Number of tokens passed to the criterion at a time.
+
+    Returns:
+    - tuple: Summed loss and number of non-ignored tokens, both as tensors on the
+             device of the outputs.
+
+    Only one chunk of the (tokens, vocab_size) softmax intermediates is alive at a
+    time, rather than one for the whole batch. When gradients are enabled, each chunk
+    is checkpointed, so its softmax is recomputed in the backward pass instead of
+    being kept until then. Dividing the summed loss by the token
+    count gives the mean over real tokens only when padding is labelled ignore_index.
+    """
+
+    flat_outputs = outputs.view(-1, vocab_size)
+    flat_labels = labels.view(-1)
+    total_loss = flat_outputs.new_zeros((), dtype=torch.float32)
+    # split() returns views whose gradients autograd joins with a single concatenation in backward
+    for output_chunk, label_chunk in zip(flat_outputs.split(chunk_size), flat_labels.split(chunk_size)):
+        if torch.is_grad_enabled():
+            chunk_loss = torch.utils.checkpoint.checkpoint(criterion, output_chunk, label_chunk, use_reentrant=False)
+        else:
+            chunk_loss = criterion(output_chunk, label_chunk)
+        total_loss = total_loss + chunk_loss
+    num_tokens = (flat_labels != criterion.ignore_index).sum()
+    return total_loss, num_tokens
+
+def train_model(train_loader, model, optimizer, criterion, device, scaler, grad_accum_steps=1, amp_dtype=None, loss_chunk_size=4096):
     """
     Train the transformer model on the training dataset.
 
     Args:
-    - train_loader (DataLoader): DataLoader for the training dataset.
+    - train_loader (iterable): DataLoader for the training dataset, optionally wrapped in a progress bar.
     - model (nn.Module): Transformer model to train.
     - optimizer (torch.optim.Optimizer): Optimizer for updating model parameters.
     - criterion: Loss criterion for computing the loss.
     - device (torch.device): Device to perform computations on (CPU or GPU).
+    - scaler (GradScaler): Gradient scaler for FP16 mixed precision (a no-op when disabled).
+    - grad_accum_steps (int): Number of batches to accumulate gradients over before each optimizer step.
+    - amp_dtype (torch.dtype): Autocast dtype for mixed precision, or None to train in FP32.
+    - loss_chunk_size (int): Number of tokens per chunk when computing the loss.
 
     Returns:
-    - float: Average training loss.
+    - float: Average training loss per token.
 
     This function trains the transformer model on the training dataset for one epoch,
     computes the average training loss, and returns it.
     """
 
     model.train()  # Set the model to training mode
-    total_train_loss = 0
+    # Accumulate on the device so the loss is only synchronised with the host once per epoch
+    total_train_loss = torch.zeros((), device=device)
+    total_train_tokens = torch.zeros((), dtype=torch.long, device=device)
+    num_batches = len(train_loader)
+    optimizer.zero_grad(set_to_none=True)  # Clear gradients before calculating them
     for i, (input_ids, labels) in enumerate(train_loader):  # Added enumeration for clarity
-        input_ids, labels = input_ids.to(device), labels.to(device)  # Move data to the appropriate device
-        optimizer.zero_grad()  # Clear gradients before calculating them
-        outputs = model(input_ids)  # Generate predictions
-        loss = criterion(outputs.view(-1, model.vocab_size), labels.view(-1))
-        loss.backward()  # Compute gradient of the loss w.r.t. network parameters
-        optimizer.step()  # Update parameters based on gradient
-
-        total_train_loss += loss.item() * input_ids.size(0)  # Accumulate the loss
-        # Update the progress bar
-        train_loader.set_description(f"Epoch {epoch} - Training")
-        train_loader.update(1)
-
-    avg_train_loss = total_train_loss / train_dataset_size
+        input_ids, labels = input_ids.to(device, non_blocking=True), labels.to(device, non_blocking=True)  # Move data to the appropriate device
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            outputs = model(input_ids)  # Generate predictions
+            loss_sum, num_tokens = compute_loss(outputs, labels, criterion, model.vocab_size, loss_chunk_size)
+            loss = loss_sum / num_tokens.clamp(min=1)
+        # Average the gradients over the batches in this accumulation window. The epoch's last window can be shorter
+        window_size = min(grad_accum_steps, num_batches - (i // grad_accum_steps) * grad_accum_steps)
+        scaler.scale(loss / window_size).backward()  # Compute gradient of the loss w.r.t. network parameters
+
+        # Update parameters once every grad_accum_steps batches, and on the final batch of the epoch
+        if (i + 1) % grad_accum_steps == 0 or (i + 1) == num_batches:
+            scaler.step(optimizer)  # Update parameters based on gradient
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
+
+        total_train_loss += loss_sum.detach()  # Accumulate the loss
+        total_train_tokens += num_tokens
+
+    avg_train_loss = (total_train_loss / total_train_tokens.clamp(min=1)).item()
     return avg_train_loss
 
 def calculate_metrics(preds, labels):
@@ -372,15 +506,66 @@ def calculate_metrics(preds, labels):
     kappa = cohen_kappa_score(labels.cpu().numpy(), preds.cpu().numpy())
     return accuracy, precision, recall, f1, kappa
 
-def validate_model(val_loader, model, criterion, device, epoch=None):
+def perplexity(loss):
+    """
+    Calculate the perplexity for an average per-token loss.
+
+    Args:
+    - loss (float): Average cross-entropy loss per token.
+
+    Returns:
+    - float: The perplexity, or inf if the loss is too large for math.exp.
+    """
+
+    try:
+        return math.exp(loss)
+    except OverflowError:
+        return float("inf")
+
+def metrics_from_counts(true_positives, pred_counts, label_counts):
+    """
+    Calculate evaluation metrics from per-class prediction counts.
+
+    Args:
+    - true_positives (Tensor): Number of correct predictions of each class.
+    - pred_counts (Tensor): Number of times each class was predicted.
+    - label_counts (Tensor): Number of times each class occurs in the labels.
+
+    Returns:
+    - tuple: Tuple containing evaluation metrics (accuracy, precision, recall, F1 score, Cohen's kappa).
+
+    Precision, recall and F1 score are macro-averaged over the classes that occur in
+    either the predictions or the labels, with zero for undefined ratios. This gives
+    the same values as sklearn's macro-averaged scores (zero_division=0) and
+    cohen_kappa_score, without collecting every prediction on the host.
+    """
+
+    tp = true_positives.double()
+    predicted = pred_counts.double()
+    actual = label_counts.double()
+    num_classes = ((predicted + actual) > 0).sum().clamp(min=1)
+    total = actual.sum().clamp(min=1)
+
+    precision = (tp / predicted.clamp(min=1)).sum() / num_classes
+    recall = (tp / actual.clamp(min=1)).sum() / num_classes
+    f1 = (2 * tp / (predicted + actual).clamp(min=1)).sum() / num_classes
+    accuracy = tp.sum() / total
+    expected_agreement = (predicted * actual).sum() / total ** 2
+    kappa = (accuracy - expected_agreement) / (1 - expected_agreement)
+
+    return tuple(torch.stack([accuracy, precision, recall, f1, kappa]).tolist())
+
+def validate_model(val_loader, model, criterion, device, amp_dtype=None, loss_chunk_size=4096):
     """
     Validate the transformer model on the validation dataset.
 
     Args:
-    - val_loader (DataLoader): DataLoader for the validation dataset.
+    - val_loader (iterable): DataLoader for the validation dataset, optionally wrapped in a progress bar.
     - model (nn.Module): Transformer model to validate.
     - criterion: Loss criterion for computing the loss.
     - device (torch.device): Device to perform computations on (CPU or GPU).
+    - amp_dtype (torch.dtype): Autocast dtype for mixed precision, or None to run in FP32.
+    - loss_chunk_size (int): Number of tokens per chunk when computing the loss.
 
     Returns:
     - tuple: Tuple containing validation metrics (average validation loss, accuracy,
@@ -392,53 +577,48 @@ def validate_model(val_loader, model, criterion, device, epoch=None):
     """
 
     model.eval()  # Set the model to evaluation mode
-    total_val_loss = 0
-    total_accuracy = 0
-    preds_all = []
-    labels_all = []
+    total_val_loss = torch.zeros((), device=device)
+    total_val_tokens = torch.zeros((), dtype=torch.long, device=device)
+    # Per-class counts are enough to compute every metric, so predictions never leave the device
+    true_positives = torch.zeros(model.vocab_size, dtype=torch.long, device=device)
+    pred_counts = torch.zeros(model.vocab_size, dtype=torch.long, device=device)
+    label_counts = torch.zeros(model.vocab_size, dtype=torch.long, device=device)
     with torch.no_grad():
         for inputs, labels in val_loader:  # Correctly unpack the tuples returned by the DataLoader
-            inputs, labels = inputs.to(device), labels.to(device)  # Move data to the appropriate device
-
-            outputs = model(inputs)  # Generate predictions from the model
-            loss = criterion(outputs.view(-1, model.vocab_size), labels.view(-1))
-            total_val_loss += loss.item() * inputs.size(0)  # Accumulate the loss
-
-            preds = outputs.argmax(dim=-1)  # Get predicted classes
-            correct = (preds == labels).sum().item()
-            accuracy = correct / labels.numel()
-            total_accuracy += accuracy * inputs.size(0)  # Accumulate the accuracy
-
-            # Collect predictions and labels for calculating additional metrics
-            preds_all.extend(preds.view(-1).tolist())
-            labels_all.extend(labels.view(-1).tolist())
-            # Update the progress bar
-            if epoch is None:
-                val_loader.set_description("Testing")
-            else:
-                val_loader.set_description(f"Epoch {epoch} - Validation")
-            val_loader.update(1)
-
-    # Calculate overall metrics from collected predictions and labels
-    avg_val_loss = total_val_loss / val_dataset_size
-    avg_val_accuracy = total_accuracy / val_dataset_size
-    precision = precision_score(labels_all, preds_all, average='macro', zero_division=0)
-    recall = recall_score(labels_all, preds_all, average='macro', zero_division=0)
-    f1 = f1_score(labels_all, preds_all, average='macro', zero_division=0)
-    kappa = cohen_kappa_score(labels_all, preds_all)
+            inputs, labels = inputs.to(device, non_blocking=True), labels.to(device, non_blocking=True)  # Move data to the appropriate device
+
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                outputs = model(inputs)  # Generate predictions from the model
+                loss_sum, num_tokens = compute_loss(outputs, labels, criterion, model.vocab_size, loss_chunk_size)
+            total_val_loss += loss_sum  # Accumulate the loss
+            total_val_tokens += num_tokens
+
+            preds = outputs.argmax(dim=-1).view(-1)  # Get predicted classes
+            flat_labels = labels.view(-1)
+            # Padded positions are labelled ignore_index (-100) by GenomeDataset.collate_batch. Excluding them
+            # here is what keeps [PAD] out of the per-class counts, so the metrics match sklearn on real tokens only
+            valid = (flat_labels != criterion.ignore_index).long()
+            safe_labels = flat_labels.clamp(min=0)  # Any index will do for ignored positions, as they add zero
+
+            # Accumulate per-class counts for calculating the metrics
+            true_positives.scatter_add_(0, safe_labels, valid * (preds == flat_labels))
+            pred_counts.scatter_add_(0, preds, valid)
+            label_counts.scatter_add_(0, safe_labels, valid)
+
+    # Calculate overall metrics from the accumulated counts
+    avg_val_loss = (total_val_loss / total_val_tokens.clamp(min=1)).item()
+    avg_val_accuracy, precision, recall, f1, kappa = metrics_from_counts(true_positives, pred_counts, label_counts)
 
     return avg_val_loss, avg_val_accuracy, precision, recall, f1, kappa
 
 
 genomes = load_dataset(input_file)
-unique_tokens = set(token for genome in genomes for token in genome.split())
-actual_vocab_size = len(unique_tokens)
-vocab_size = min(actual_vocab_size, max_vocab_size)
 num_sequences = len(genomes)
-sequence_lengths = [len(genome.split()) for genome in genomes]
-min_sequence_length = min(sequence_lengths)
-max_sequence_length = max(sequence_lengths)
-avg_sequence_length = sum(sequence_lengths) / num_sequences
+# Gene names are separated by single spaces, so counting spaces gives the number of genes without splitting
+sequence_lengths = np.fromiter((genome.count(" ") + 1 if genome else 0 for genome in genomes), dtype=np.int64, count=num_sequences)
+min_sequence_length = sequence_lengths.min()
+max_sequence_length = sequence_lengths.max()
+avg_sequence_length = sequence_lengths.mean()
 
 logging.info(
     f"Dataset loaded: {num_sequences} sequences\n"
@@ -447,12 +627,22 @@ logging.info(
 
 tokenizer = Tokenizer(models.WordLevel(unk_token="[UNK]"))
 tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
-trainer = trainers.WordLevelTrainer(special_tokens=["[UNK]", "[CLS]", "[SEP]", "[PAD]", "[MASK]"], vocab_size=vocab_size)
-tokenizer.train_from_iterator(genomes, trainer)
+# The trainer keeps at most max_vocab_size of the most frequent tokens; the actual vocab size is read back below
+trainer = trainers.WordLevelTrainer(special_tokens=["[UNK]", "[CLS]", "[SEP]", "[PAD]", "[MASK]"], vocab_size=max_vocab_size)
+tokenizer.train_from_iterator(genomes, trainer, length=len(genomes))
 tokenizer.save(tokenizer_file)
 tokenizer = Tokenizer.from_file(tokenizer_file)
 vocab_size = tokenizer.get_vocab_size()
 
+# Tokenize the whole corpus once, in parallel, and split the token ids rather than the raw text.
+# Encode in slices, so only one slice of full Encoding objects (tokens, offsets, masks) is alive at a time
+encode_slice_size = 10000
+encoded_genomes = []
+for start in range(0, len(genomes), encode_slice_size):
+    encodings = tokenizer.encode_batch(genomes[start:start + encode_slice_size])
+    encoded_genomes.extend(np.asarray(encoding.ids[:max_seq_length], dtype=np.int32) for encoding in encodings)
+genomes = encoded_genomes
+
 if train_size + val_size > 1.0:
     raise ValueError("The sum of train_size and val_size must be less than or equal to 1.0")
 if train_size + val_size == 1.0:
@@ -484,12 +674,13 @@ class PositionalEncoding(nn.Module):
     def __init__(self, d_model, max_len, dropout=pe_dropout_rate):
         super().__init__()
         self.dropout = nn.Dropout(p=dropout)
-        pe = torch.zeros(max_len, d_model)
-        position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
+        position = torch.arange(0, max_len, dtype=torch.float)
         div_term = torch.exp(torch.arange(0, d_model, 2).float() * (-math.log(10000.0) / d_model))
-        pe[:, 0::2] = torch.sin(position * div_term)
-        pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0).transpose(0, 1)
+        angles = torch.outer(position, div_term)
+        pe = torch.empty(max_len, d_model)
+        pe[:, 0::2] = angles.sin()
+        pe[:, 1::2] = angles.cos_()  # angles is not needed after this, so take the cosine in place
+        pe = pe.unsqueeze(1)
         self.register_buffer("pe", pe)
 
     def forward(self, x):
@@ -608,48 +799,134 @@ class GenomeDataset(torch.utils.data.Dataset):
     This class represents a dataset of genomic sequences for training, validation, or testing.
 
     Args:
-    - texts (list): List of genomic sequences.
-    - tokenizer (Tokenizer): Tokenizer for encoding genomic sequences.
+    - encoded (list): Token ids of each genomic sequence, as integer arrays.
+    - tokenizer (Tokenizer): Tokenizer the sequences were encoded with.
     - max_length (int): Maximum length of the input sequence.
 
+    Attributes:
+    - encoded (list): Token ids of each genomic sequence, truncated to max_length.
+    - lengths (np.ndarray): Number of token ids in each entry of encoded.
+
     Methods:
     - __len__(): Get the length of the dataset.
     - __getitem__(idx): Get an item from the dataset by index.
+    - collate_batch(batch): Pad a list of items into a batch.
     """
 
-    def __init__(self, texts, tokenizer, max_length):
-        self.tokenizer = tokenizer
-        self.texts = texts
+    def __init__(self, encoded, tokenizer, max_length):
         self.max_length = max_length
+        self.pad_token = tokenizer.token_to_id("[PAD]")
+        self.label_pad_token = -100  # The default ignore_index of CrossEntropyLoss, so padded targets are not scored
+        # A sequence needs at least 2 tokens to give a non-empty input and label, so drop shorter ones.
+        # Otherwise a batch of only such sequences would pad to length 0 and have no tokens to score
+        self.encoded = [ids[:max_length] for ids in encoded if len(ids) >= 2]
+        self.lengths = np.array([len(ids) for ids in self.encoded], dtype=np.int64)
 
     def __len__(self):
-        return len(self.texts)
+        return len(self.encoded)
 
     def __getitem__(self, idx):
-        text = self.texts[idx]
-        encoded = self.tokenizer.encode(text).ids
-
-        # Ensure the sequence is not longer than max_length
-        if len(encoded) > self.max_length:
-            encoded = encoded[:self.max_length]
-        
-        # Input is all but the last token
-        input_ids = encoded[:-1]
-        # Labels are all but the first token, shifted by one
-        label_ids = encoded[1:]
-
-        # Pad the sequence to the nearest multiple of the attention window size (for Longformer)
+        encoded = torch.from_numpy(self.encoded[idx]).long()
+
+        # Input is all but the last token, labels are all but the first token, shifted by one
+        return encoded[:-1], encoded[1:]
+
+    def collate_batch(self, batch):
+        """
+        Pad the items of a batch to a common length.
+
+        Args:
+        - batch (list): List of (input_ids, label_ids) tuples from __getitem__.
+
+        Returns:
+        - tuple: Padded input ids and label ids, each of shape (batch, padded_length).
+
+        Sequences are only padded to the longest sequence in the batch, rounded up to
+        the nearest multiple of the attention window size for Longformer, rather than
+        to max_length. Inputs are padded with the [PAD] token and labels with -100, so
+        padded positions are left out of the loss and metrics whatever the batch length.
+        """
+
+        seq_length = max(input_ids.size(0) for input_ids, _ in batch)
         if hasattr(self, 'attention_window'):
-            seq_length = len(input_ids)
             padded_length = ((seq_length + self.attention_window - 1) // self.attention_window) * self.attention_window
-            input_ids = input_ids + [self.tokenizer.token_to_id("[PAD]")] * (padded_length - seq_length)
-            label_ids = label_ids + [self.tokenizer.token_to_id("[PAD]")] * (padded_length - seq_length)
         else:
-            # Pad the sequence to max_length (for transformer)
-            input_ids = input_ids + [self.tokenizer.token_to_id("[PAD]")] * (self.max_length - 1 - len(input_ids))
-            label_ids = label_ids + [self.tokenizer.token_to_id("[PAD]")] * (self.max_length - 1 - len(label_ids))
+            padded_length = seq_length
+
+        input_ids = torch.full((len(batch), padded_length), self.pad_token, dtype=torch.long)
+        label_ids = torch.full((len(batch), padded_length), self.label_pad_token, dtype=torch.long)
+        for i, (item_input_ids, item_label_ids) in enumerate(batch):
+            input_ids[i, :item_input_ids.size(0)] = item_input_ids
+            label_ids[i, :item_label_ids.size(0)] = item_label_ids
+
+        return input_ids, label_ids
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler that groups sequences of similar length.
+
+    Batches padded to their longest sequence waste less compute when the sequences
+    within each batch have similar lengths.
+
+    Args:
+    - lengths (np.ndarray): Length of each sequence in the dataset.
+    - batch_size (int): Number of sequences per batch.
+    - shuffle (bool): Whether to shuffle the batches every epoch.
+    - pool_factor (int): Number of batches that are sorted by length together in each pool.
+
+    Methods:
+    - __iter__(): Yield lists of dataset indices, one per batch.
+    - __len__(): Get the number of batches.
+
+    When shuffling, the indices are shuffled and split into pools of
+    batch_size * pool_factor sequences. Each pool is sorted by length and cut into
+    batches, and the order of all batches is shuffled. Without shuffling, the
+    batches are taken from the indices sorted by length.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, pool_factor=100):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = batch_size * pool_factor
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = np.random.permutation(len(self.lengths))
+            pools = [indices[i:i + self.pool_size] for i in range(0, len(indices), self.pool_size)]
+            indices = np.concatenate([pool[np.argsort(self.lengths[pool], kind="stable")] for pool in pools]) if pools else indices
+        else:
+            indices = np.argsort(self.lengths, kind="stable")
+
+        batches = [indices[i:i + self.batch_size].tolist() for i in range(0, len(indices), self.batch_size)]
+        if self.shuffle:
+            random.shuffle(batches)
+        return iter(batches)
 
-        return torch.tensor(input_ids, dtype=torch.long), torch.tensor(label_ids, dtype=torch.long)
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def create_data_loader(dataset, batch_size, shuffle, bucket_by_length, **loader_kwargs):
+    """
+    Create a DataLoader that pads each batch to its longest sequence.
+
+    Args:
+    - dataset (GenomeDataset): Dataset to load batches from.
+    - batch_size (int): Number of sequences per batch.
+    - shuffle (bool): Whether to shuffle the data every epoch.
+    - bucket_by_length (bool): Whether to batch sequences of similar length together.
+    - loader_kwargs: Additional keyword arguments passed to the DataLoader.
+
+    Returns:
+    - DataLoader: DataLoader for the dataset.
+    """
+
+    if bucket_by_length:
+        batch_sampler = BucketBatchSampler(dataset.lengths, batch_size, shuffle=shuffle)
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=dataset.collate_batch, **loader_kwargs)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=dataset.collate_batch, **loader_kwargs)
 
 
 class EarlyStopping:
@@ -708,29 +985,60 @@ early_stopping = EarlyStopping(patience=early_stop_patience, min_delta=min_delta
 total_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
 print(f"Total number of trainable parameters: {total_params}", flush=True)
 
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu") # Run on a GPU if one is available
+logging.info(f"device = {device}")
+# Gradient scaling, which FP16 training depends on, is only supported on CUDA
+if args.amp == "fp16" and device.type != "cuda":
+    print("Error: --amp fp16 requires a CUDA GPU. Use --amp bf16 or --amp off on this device.")
+    exit(1)
+
+# Worker processes, pinned host memory and prefetching keep the GPU fed while batches are prepared.
+# Batches are plain tuples of tensors, which the DataLoader pins directly. Each prefetched batch holds
+# pinned host memory, so lower --prefetch_factor where page-locked memory is scarce.
+pin_memory = device.type == "cuda" and not args.no_pin_memory
+loader_kwargs = {"num_workers": num_workers, "pin_memory": pin_memory}
+if num_workers > 0:
+    loader_kwargs.update(persistent_workers=True, prefetch_factor=prefetch_factor)
+
 # training dataset
 train_dataset = GenomeDataset(train_genomes, tokenizer, max_seq_length)
 if args.model_type == "longformer":
     train_dataset.attention_window = longformer_attention_window
-train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-train_dataset_size = len(train_loader.dataset)
+train_loader = create_data_loader(train_dataset, batch_size, True, bucket_by_length, **loader_kwargs)
 
 # validation dataset
 val_dataset = GenomeDataset(val_genomes, tokenizer, max_seq_length)
 if args.model_type == "longformer":
     val_dataset.attention_window = longformer_attention_window
-val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
-val_dataset_size = len(val_loader.dataset)
-
-criterion = torch.nn.CrossEntropyLoss() # what are we trying to optimize?
-optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate, weight_decay=weight_decay) # How are we trying to optimizer it?
-lr_scheduler = ReduceLROnPlateau(optimizer, mode="min", factor=lr_scheduler_factor, patience=lr_patience, verbose=True) # taking big, then small steps
-
+val_loader = create_data_loader(val_dataset, batch_size, False, bucket_by_length, **loader_kwargs)
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu") # Run on a GPU if one is available
-logging.info(f"device = {device}")
+criterion = torch.nn.CrossEntropyLoss(reduction="sum") # what are we trying to optimize? (summed, then averaged per token)
 model.to(device)
 
+# How are we trying to optimizer it? The fused CUDA kernels update every parameter in a single launch
+# Only pass fused when it is wanted, as older PyTorch versions do not accept the argument at all
+use_fused = device.type == "cuda"
+fused_kwargs = {"fused": True} if use_fused else {}
+if optimizer_name == "adam":
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate, weight_decay=weight_decay, **fused_kwargs)
+elif optimizer_name == "adamw":
+    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, weight_decay=weight_decay, **fused_kwargs)
+elif optimizer_name == "adamw_8bit":
+    try:
+        import bitsandbytes as bnb
+    except ImportError:
+        print("Error: The 'adamw_8bit' optimizer requires the bitsandbytes package (pip install bitsandbytes).")
+        exit(1)
+    optimizer = bnb.optim.AdamW8bit(model.parameters(), lr=learning_rate, weight_decay=weight_decay)
+else:
+    raise ValueError(f"Invalid optimizer: {optimizer_name}")
+# FP16 gradients need loss scaling to avoid underflow. torch.amp.GradScaler replaces the deprecated torch.cuda.amp one
+if hasattr(torch.amp, "GradScaler"):
+    scaler = torch.amp.GradScaler(device.type, enabled=args.amp == "fp16")
+else:
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp == "fp16")
+lr_scheduler = ReduceLROnPlateau(optimizer, mode="min", factor=lr_scheduler_factor, patience=lr_patience, verbose=True) # taking big, then small steps
+
 start_epoch, is_checkpoint_loaded = load_checkpoint(model, optimizer, model_save_path)
 
 if is_checkpoint_loaded:
@@ -739,22 +1047,27 @@ else:
     logging.info("Starting training from scratch.")
     start_epoch = 0
 
+# Compiled copy of the model used for the forward/backward passes; checkpoints are still saved from the
+# uncompiled model so their state_dict keys stay loadable. Batch lengths vary, so compile for dynamic shapes.
+compiled_model = torch.compile(model, dynamic=True) if args.compile else model
+
 print(f"vocab_size: {vocab_size} | embed_dim: {embed_dim} | num_heads: {num_heads} | num_layers: {num_layers} | max_seq_length: {max_seq_length}", flush=True)
+writer = SummaryWriter(log_dir=log_dir)
 for epoch in range(start_epoch, epochs):
-    writer = SummaryWriter(log_dir=log_dir)
     # Training model loop
-    train_loader = tqdm(train_loader, desc=f"Epoch {epoch} - Training", unit="batch")
-    avg_train_loss = train_model(train_loader, model, optimizer, criterion, device)
-    train_perplexity = torch.exp(torch.tensor(avg_train_loss))
+    # Wrap the loaders in a fresh progress bar each epoch, keeping the DataLoaders themselves intact
+    train_iter = tqdm(train_loader, desc=f"Epoch {epoch} - Training", unit="batch")
+    avg_train_loss = train_model(train_iter, compiled_model, optimizer, criterion, device, scaler, grad_accum_steps, amp_dtype, loss_chunk_size)
+    train_perplexity = perplexity(avg_train_loss)
     # Log training metrics
     logging.info(f'Epoch {epoch} - Training Loss: {avg_train_loss}, Perplexity: {train_perplexity}, Learning Rate: {optimizer.param_groups[0]["lr"]}')
     writer.add_scalar("Loss/train", avg_train_loss, epoch)
     writer.add_scalar("Perplexity/train", train_perplexity, epoch)
 
     # Validate model loop
-    val_loader = tqdm(val_loader, desc=f"Epoch {epoch} - Validation", unit="batch")
-    avg_val_loss, val_accuracy, val_precision, val_recall, val_f1, val_kappa = validate_model(val_loader, model, criterion, device, epoch)
-    val_perplexity = torch.exp(torch.tensor(avg_val_loss))
+    val_iter = tqdm(val_loader, desc=f"Epoch {epoch} - Validation", unit="batch")
+    avg_val_loss, val_accuracy, val_precision, val_recall, val_f1, val_kappa = validate_model(val_iter, compiled_model, criterion, device, amp_dtype, loss_chunk_size)
+    val_perplexity = perplexity(avg_val_loss)
     # Log validation metrics
     logging.info(f'Epoch {epoch} - Validation Loss: {avg_val_loss}, Perplexity: {val_perplexity}, Accuracy: {val_accuracy}, Precision: {val_precision}, Recall: {val_recall}, F1: {val_f1}, Kappa: {val_kappa}')
     writer.add_scalar("Loss/val", avg_val_loss, epoch)
@@ -775,19 +1088,17 @@ for epoch in range(start_epoch, epochs):
         print("Saving model checkpoint.", flush=True)
         save_checkpoint(model, optimizer, epoch, avg_train_loss, model_save_path)
 
-    gc.collect()
-    writer.close()
+writer.close()
 
 if len(test_genomes) > 0:
     test_dataset = GenomeDataset(test_genomes, tokenizer, max_seq_length)
     if args.model_type == "longformer":
         test_dataset.attention_window = longformer_attention_window
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
-    test_dataset_size = len(test_loader.dataset)  # Store the size of the test dataset
-    test_loader = tqdm(test_loader, desc="Testing", unit="batch")
+    test_loader = create_data_loader(test_dataset, batch_size, False, bucket_by_length, **loader_kwargs)
+    test_iter = tqdm(test_loader, desc="Testing", unit="batch")
     # Test Model Loop
-    test_loss, test_accuracy, test_precision, test_recall, test_f1, test_kappa = validate_model(test_loader, model, criterion, device)
-    test_perplexity = torch.exp(torch.tensor(test_loss))
+    test_loss, test_accuracy, test_precision, test_recall, test_f1, test_kappa = validate_model(test_iter, compiled_model, criterion, device, amp_dtype=amp_dtype, loss_chunk_size=loss_chunk_size)
+    test_perplexity = perplexity(test_loss)
     # Log test metrics
     logging.info(f'Test Loss: {test_loss}, Perplexity: {test_perplexity}, Accuracy: {test_accuracy}, Precision: {test_precision}, Recall: {test_recall}, F1: {test_f1}, Kappa: {test_kappa}')
     # Create a new SummaryWriter instance for test metrics
@@ -804,4 +1115,4 @@ if len(test_genomes) > 0:
 else:
     print("No test set available for evaluation.", flush=True)
 
-
+wait_for_checkpoint()  # Make sure the last checkpoint is on disk before exiting
@@ -1,10 +1,12 @@
+import argparse
+import contextlib
+import inspect
 import torch
 import torch.nn as nn
 from tokenizers import Tokenizer
 from torch.utils.data import DataLoader, Dataset
 import math
 import torch.nn.functional as F
-from panGPT import SimpleTransformerModel, SimpleReformerModel
 
 class PositionalEncoding(nn.Module):
     """
@@ -22,12 +24,13 @@ class PositionalEncoding(nn.Module):
     def __init__(self, d_model, dropout=0.1, max_len=None):
         super().__init__()
         self.dropout = nn.Dropout(p=dropout)
-        pe = torch.zeros(max_len, d_model)
-        position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
+        position = torch.arange(0, max_len, dtype=torch.float)
         div_term = torch.exp(torch.arange(0, d_model, 2).float() * (-math.log(10000.0) / d_model))
-        pe[:, 0::2] = torch.sin(position * div_term)
-        pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0).transpose(0, 1)
+        angles = torch.outer(position, div_term)
+        pe = torch.empty(max_len, d_model)
+        pe[:, 0::2] = angles.sin()
+        pe[:, 1::2] = angles.cos_()  # angles is not needed after this, so take the cosine in place
+        pe = pe.unsqueeze(1)
         self.register_buffer("pe", pe)
 
     def forward(self, x):
@@ -45,6 +48,7 @@ class SimpleTransformerModel(nn.Module):
         num_layers (int): Number of layers (stacks) in the transformer.
         max_seq_length (int): Maximum length of the input sequences.
         dropout_rate (float): Dropout rate in the transformer.
+        pe_max_len (int): Number of positions in the positional encoding table.
 
     The model consists of an embedding layer, positional encoding, and a transformer encoder.
     """
@@ -57,9 +61,10 @@ class SimpleTransformerModel(nn.Module):
         num_layers,
         max_seq_length,
         dropout_rate=0.5,
+        pe_max_len=5000,
     ):
         super(SimpleTransformerModel, self).__init__()
-        self.pos_encoding = PositionalEncoding(embed_dim, dropout=dropout_rate)
+        self.pos_encoding = PositionalEncoding(embed_dim, dropout=dropout_rate, max_len=pe_max_len)
         self.vocab_size = vocab_size
         self.embed = nn.Embedding(vocab_size, embed_dim)
         transformer_layer = nn.TransformerEncoderLayer(
@@ -88,18 +93,28 @@ def print_banner():
     print(banner)
 
 def load_model(model_path, model_type, embed_dim, num_heads, num_layers, max_seq_length, device, reformer_depth=None, reformer_buckets=None, reformer_hashes=None):
-    # Infer the vocab size from the model checkpoint
-    checkpoint = torch.load(model_path, map_location=device)
+    # Infer the vocab size from the model checkpoint. Load it onto the CPU so the weights are copied to the
+    # device once, by model.to(device) below, and memory-map it (PyTorch 2.1+) so the file is not read into RAM up front
+    load_parameters = inspect.signature(torch.load).parameters
+    load_kwargs = {key: True for key in ('mmap', 'weights_only') if key in load_parameters}
+    checkpoint = torch.load(model_path, map_location='cpu', **load_kwargs)
     vocab_size = checkpoint['model_state_dict']['embed.weight'].size(0)
 
-    if model_type == 'transformer':
-        model = SimpleTransformerModel(vocab_size, embed_dim, num_heads, num_layers, max_seq_length)
-    elif model_type == 'reformer':
-        model = SimpleReformerModel(vocab_size, embed_dim, reformer_depth, reformer_buckets, reformer_hashes)
-    else:
-        raise ValueError(f"Unknown model type: {model_type}")
-
-    model.load_state_dict(checkpoint['model_state_dict'])
+    # Build the model on the meta device, so no weights are allocated or randomly initialised only to be overwritten.
+    # This needs torch.device to work as a context manager (PyTorch 2.0+) and load_state_dict's assign argument (2.1+)
+    use_meta = hasattr(torch.device, '__enter__') and 'assign' in inspect.signature(nn.Module.load_state_dict).parameters
+    with torch.device('meta') if use_meta else contextlib.nullcontext():
+        if model_type == 'transformer':
+            # The positional encoding buffer is saved in the checkpoint, so build a table of the same length
+            pe_max_len = checkpoint['model_state_dict']['pos_encoding.pe'].size(0)
+            model = SimpleTransformerModel(vocab_size, embed_dim, num_heads, num_layers, max_seq_length, pe_max_len=pe_max_len)
+        elif model_type == 'reformer':
+            raise ValueError("The reformer model is not available: panGPT does not define a Reformer model")
+        else:
+            raise ValueError(f"Unknown model type: {model_type}")
+
+    # assign=True adopts the checkpoint tensors as the model's parameters and buffers instead of copying into them
+    model.load_state_dict(checkpoint['model_state_dict'], **({'assign': True} if use_meta else {}))
     model.to(device)
     return model, vocab_size
 
@@ -107,18 +122,21 @@ def load_model(model_path, model_type, embed_dim, num_heads, num_layers, max_seq
 def load_tokenizer(tokenizer_path):
     return Tokenizer.from_file(tokenizer_path)
 
-def predict_next_tokens(model, tokenizer, prompt, num_tokens, temperature=1.0):
+def predict_next_tokens(model, tokenizer, prompt, num_tokens, temperature=1.0, device=torch.device('cpu'), amp_dtype=None):
     model.eval()
-    tokens = tokenizer.encode(prompt).ids
-    for _ in range(num_tokens):
-        input_ids = torch.tensor([tokens])
-        with torch.no_grad():
-            outputs = model(input_ids)
-        scaled_logits = outputs[0, -1, :] / temperature
+    prompt_ids = tokenizer.encode(prompt).ids
+    prompt_length = len(prompt_ids)
+    # Allocate room for the prompt and every predicted token once, and feed the model a growing view of it
+    tokens = torch.empty((1, prompt_length + num_tokens), dtype=torch.long, device=device)
+    tokens[0, :prompt_length] = torch.tensor(prompt_ids, dtype=torch.long)
+    for i in range(prompt_length, prompt_length + num_tokens):
+        with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            outputs = model(tokens[:, :i])
+        scaled_logits = outputs[0, -1, :].float() / temperature
         probabilities = F.softmax(scaled_logits, dim=-1)
-        next_token_id = torch.multinomial(probabilities, 1).item()
-        tokens.append(next_token_id)
-    return tokenizer.decode(tokens)
+        # Write the sampled token straight into the device buffer, so the host never waits on the GPU mid-loop
+        tokens[0, i:i + 1] = torch.multinomial(probabilities, 1)
+    return tokenizer.decode(tokens[0].tolist())
 
 def read_prompt_file(file_path):
     with open(file_path, 'r') as file:
@@ -143,9 +161,16 @@ def main():
     parser.add_argument("--reformer_depth", type=int, default=6, help="Depth of the Reformer model.")
     parser.add_argument("--reformer_buckets", type=int, default=32, help="Number of buckets in the Reformer model.")
     parser.add_argument("--reformer_hashes", type=int, default=4, help="Number of hashes in the Reformer model.")
+    parser.add_argument("--amp", type=str, default="off", choices=['off', 'fp16', 'bf16'], help="Mixed precision mode for prediction (off for full FP32, fp16 or bf16; fp16 and bf16 also allow TF32 matmuls).")
     args = parser.parse_args()
 
     device = torch.device(args.device)
+    amp_dtype = {'off': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}[args.amp]
+    if args.amp == 'fp16' and device.type != 'cuda':
+        print("Error: --amp fp16 requires a CUDA device. Use --amp bf16 or --amp off on this device.")
+        exit(1)
+    if amp_dtype is not None:
+        torch.set_float32_matmul_precision('high')  # Allow TF32 tensor cores for the remaining FP32 matmuls
 
     model, vocab_size = load_model(args.model_path, args.model_type, args.embed_dim, args.num_heads, args.num_layers,
                                    args.max_seq_length, device, args.reformer_depth, args.reformer_buckets, args.reformer_hashes)
@@ -154,7 +179,7 @@ def main():
     tokenizer = load_tokenizer(args.tokenizer_path)
 
     prompt = read_prompt_file(args.prompt_file)
-    predicted_text = predict_next_tokens(model, tokenizer, prompt, args.num_tokens, args.temperature, device)
+    predicted_text = predict_next_tokens(model, tokenizer, prompt, args.num_tokens, args.temperature, device, amp_dtype)
     print("Prompt:", prompt)
     print("Predicted text:", predicted_text)
 